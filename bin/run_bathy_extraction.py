@@ -10,7 +10,6 @@ WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
 IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-import cshelph.run_cshelph
 import argparse
 import traceback
 
@@ -136,6 +135,10 @@ def main():
         "SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.\n")
     )
 
+    # Imported here so --help and argument errors do not wait on numpy,
+    # pandas, etc. being imported
+    import cshelph.run_cshelph
+
     try:
         cshelph.run_cshelph.run_cshelph(
             args.input,
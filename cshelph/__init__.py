@@ -10,7 +10,7 @@ WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR
 IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from distutils.version import LooseVersion
+from packaging.version import Version
 
 CSHELPH_VERSION_MAJOR = 3
 CSHELPH_VERSION_MINOR = 0
@@ -19,5 +19,5 @@ CSHELPH_VERSION_PATCH = 2
 CSHELPH_VERSION = (
     f"{CSHELPH_VERSION_MAJOR}.{CSHELPH_VERSION_MINOR}.{CSHELPH_VERSION_PATCH}"
 )
-CSHELPH_VERSION_OBJ = LooseVersion(CSHELPH_VERSION)
+CSHELPH_VERSION_OBJ = Version(CSHELPH_VERSION)
 __version__ = CSHELPH_VERSION
@@ -11,10 +11,12 @@ IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 import os
+from dataclasses import dataclass, fields, replace
+from functools import lru_cache
+from importlib.util import find_spec
+from typing import Optional
 import numpy as np
 import h5py as h5
-import matplotlib.pyplot as plt
-from pyproj import Proj
 from pyproj import Transformer
 import pandas as pd
 import time
@@ -22,58 +24,194 @@ import geopandas
 import utm
 import xarray as xr
 import earthaccess
+from numba import njit, prange
+from packaging.version import Version
 
 # need s3fs installed
 
 
-def read_atl03(h5_file, laser_num):
-    if not os.path.exists(h5_file):
-        raise FileNotFoundError(f"Cannot find {h5_file} - check file path provided")
+@dataclass
+class PhotonTable:
+    """
+    Photon level data stored as a set of equal length 1D numpy arrays, one
+    per column. Columns which are not available at a given processing stage
+    are None. bin_data() populates lat_bins and height_bins with the bin
+    index of each photon.
+    """
 
-    # Read File
-    f = h5.File(h5_file, "r")
+    latitude: np.ndarray
+    longitude: np.ndarray
+    photon_height: np.ndarray
+    confidence: Optional[np.ndarray] = None
+    ref_elevation: Optional[np.ndarray] = None
+    ref_azimuth: Optional[np.ndarray] = None
+    ref_sat_alt: Optional[np.ndarray] = None
+    cor_latitude: Optional[np.ndarray] = None
+    cor_longitude: Optional[np.ndarray] = None
+    cor_photon_height: Optional[np.ndarray] = None
+    depth: Optional[np.ndarray] = None
+    lat_bins: Optional[np.ndarray] = None
+    height_bins: Optional[np.ndarray] = None
+    n_lat_bins: int = 0
+    n_height_bins: int = 0
+
+    def __len__(self):
+        return len(self.photon_height)
+
+    def columns(self):
+        """Return the names of the populated photon level columns"""
+        return [
+            field.name
+            for field in fields(self)
+            if isinstance(getattr(self, field.name), np.ndarray)
+        ]
+
+    def select(self, mask):
+        """
+        Return a new PhotonTable with only the photons where mask is True
+        (or, for an integer array, the photons at those indices)
+        """
+        return replace(
+            self, **{name: getattr(self, name)[mask] for name in self.columns()}
+        )
+
+    def to_dataframe(self, columns=None):
+        """Materialise the table (or the listed columns) as a pandas DataFrame"""
+        if columns is None:
+            columns = self.columns()
+        return pd.DataFrame({name: getattr(self, name) for name in columns})
+
+    @classmethod
+    def from_dataframe(cls, dataframe):
+        """Create a PhotonTable from a dataframe with matching column names"""
+        # the notebook and earlier versions used the 'ref_azminuth' spelling
+        dataframe = dataframe.rename(columns={"ref_azminuth": "ref_azimuth"})
+        names = {field.name for field in fields(cls)}
+        return cls(
+            **{
+                name: dataframe[name].to_numpy()
+                for name in dataframe.columns
+                if name in names
+            }
+        )
 
-    # Select a laser
-    orientation = f["/orbit_info/sc_orient"][0]
 
-    # selects the strong beams only [we can include weak beams later on]
-    orientDict = {0: "l", 1: "r", 21: "error"}
-    laser = f"gt{laser_num}{orientDict[orientation]}"
+def _read_dataset(dataset, column=None, dtype=None):
+    """
+    Read a h5py dataset directly into a preallocated numpy array. If column
+    is given only that column of a 2D dataset is read. If dtype is given the
+    values are converted by HDF5 as they are read.
+    """
+    if dtype is None:
+        dtype = dataset.dtype
 
-    laser_height_path = f"/{laser}/heights"
-    if laser_height_path not in f:
-        f.close()
-        raise Exception(
-            f"{laser_height_path} does not exist in file. "
-            f"It is likely that the file does not have any returns"
+    if column is None:
+        out = np.empty(dataset.shape, dtype=dtype)
+        dataset.read_direct(out)
+    else:
+        out = np.empty(dataset.shape[0], dtype=dtype)
+        dataset.read_direct(out, source_sel=np.s_[:, column])
+
+    return out
+
+
+def _prime_above(n):
+    """Return the smallest prime number greater than n"""
+    candidate = max(int(n) + 1, 2)
+    while any(candidate % i == 0 for i in range(2, int(candidate**0.5) + 1)):
+        candidate += 1
+
+    return candidate
+
+
+def _num_chunks(dataset):
+    """Return the number of chunks a h5py dataset is stored in"""
+    if dataset.chunks is None:
+        return 1
+
+    return int(
+        np.prod(
+            [-(-size // chunk) for size, chunk in zip(dataset.shape, dataset.chunks)]
         )
+    )
 
-    # Read in the required photon level data
-    photon_h = f[f"/{laser}/heights/h_ph"][...,]
-    latitude = f[f"/{laser}/heights/lat_ph"][...,]
-    longitude = f[f"/{laser}/heights/lon_ph"][...,]
-    conf = f[f"/{laser}/heights/signal_conf_ph/"][..., 0]
 
-    # params needed for refraction correction
+def read_atl03(h5_file, laser_num):
+    if not os.path.exists(h5_file):
+        raise FileNotFoundError(f"Cannot find {h5_file} - check file path provided")
+
+    # Read File
+    with h5.File(h5_file, "r") as f:
+        # Select a laser
+        orientation = f["/orbit_info/sc_orient"][0]
+
+        # selects the strong beams only [we can include weak beams later on]
+        orientDict = {0: "l", 1: "r", 21: "error"}
+        laser = f"gt{laser_num}{orientDict[orientation]}"
+
+        laser_height_path = f"/{laser}/heights"
+        if laser_height_path not in f:
+            raise Exception(
+                f"{laser_height_path} does not exist in file. "
+                f"It is likely that the file does not have any returns"
+            )
 
-    ref_elev = f[f"/{laser}/geolocation/ref_elev"][...,]
-    ref_azimuth = f[f"/{laser}/geolocation/ref_azimuth"][...,]
-    ph_index_beg = f[f"/{laser}/geolocation/ph_index_beg"][...,]
-    segment_id = f[f"/{laser}/geolocation/segment_id"][...,]
-    altitude_sc = f[f"/{laser}/geolocation/altitude_sc"][...,]
-    seg_ph_count = f[f"/{laser}/geolocation/segment_ph_cnt"][...,]
+        # The required photon level data followed by the params needed for
+        # refraction correction
+        paths = {
+            "photon_h": f"/{laser}/heights/h_ph",
+            "latitude": f"/{laser}/heights/lat_ph",
+            "longitude": f"/{laser}/heights/lon_ph",
+            "conf": f"/{laser}/heights/signal_conf_ph",
+            "ref_elev": f"/{laser}/geolocation/ref_elev",
+            "ref_azimuth": f"/{laser}/geolocation/ref_azimuth",
+            "ph_index_beg": f"/{laser}/geolocation/ph_index_beg",
+            "segment_id": f"/{laser}/geolocation/segment_id",
+            "altitude_sc": f"/{laser}/geolocation/altitude_sc",
+            "seg_ph_count": f"/{laser}/geolocation/segment_ph_cnt",
+        }
+
+        # Count the chunks of the beam so the file can be reopened with a
+        # chunk cache large enough to hold them. Each chunk is only read once
+        # so chunks are simply evicted in least recently used order
+        # (rdcc_w0=0).
+        n_chunks = sum(_num_chunks(f[path]) for path in paths.values())
+
+    # Each dataset is read as a single hyperslab into a preallocated array.
+    # The reads are sequential as h5py serialises calls into the HDF5
+    # library (including decompression), so threads would not overlap them.
+    # Segment indices and counts are read straight into int64 arrays.
+    columns = {"conf": 0}
+    dtypes = {
+        "ph_index_beg": np.int64,
+        "segment_id": np.int64,
+        "seg_ph_count": np.int64,
+    }
+    with h5.File(
+        h5_file,
+        "r",
+        rdcc_nbytes=256 * 1024 * 1024,
+        rdcc_nslots=_prime_above(10 * n_chunks),
+        rdcc_w0=0.0,
+    ) as f:
+        data = {
+            name: _read_dataset(
+                f[path], column=columns.get(name), dtype=dtypes.get(name)
+            )
+            for name, path in paths.items()
+        }
 
     return (
-        latitude,
-        longitude,
-        photon_h,
-        conf,
-        ref_elev,
-        ref_azimuth,
-        ph_index_beg,
-        segment_id,
-        altitude_sc,
-        seg_ph_count,
+        data["latitude"],
+        data["longitude"],
+        data["photon_h"],
+        data["conf"],
+        data["ref_elev"],
+        data["ref_azimuth"],
+        data["ph_index_beg"],
+        data["segment_id"],
+        data["altitude_sc"],
+        data["seg_ph_count"],
     )
 
 
@@ -89,14 +227,19 @@ def convert_wgs_to_utm(lat, lon):
     return epsg
 
 
+@lru_cache(maxsize=None)
+def _get_transformer(crs_from, crs_to):
+    """Return a (cached) always_xy pyproj Transformer between two CRSs"""
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
 def orthometric_correction(lat, lon, Z, epsg):
     # transform ellipsod (WGS84) height to orthometric height
-    transformerh = Transformer.from_crs("epsg:4326", "epsg:3855", always_xy=True)
+    transformerh = _get_transformer("epsg:4326", "epsg:3855")
     X_egm08, Y_egm08, Z_egm08 = transformerh.transform(lon, lat, Z)
 
     # transform WGS84 proj to local UTM
-    myproj = Proj(epsg)
-    X_utm, Y_utm = myproj(lon, lat)
+    X_utm, Y_utm = _get_transformer("epsg:4326", epsg).transform(lon, lat)
 
     return Y_utm, X_utm, Z_egm08
 
@@ -118,114 +261,124 @@ def count_ph_per_seg(ph_index_beg, photon_h):  # DEpRECATED
 
 
 def ref_linear_interp(photon_count, ref_elev):
-    arr = []
-    for i in range(len(ref_elev)):
-        try:
-            min_val = ref_elev[i - 1]
-            max_val = ref_elev[i]
-        except:
-            min_val = ref_elev[i]
-            max_val = ref_elev[i]
-
-        try:
-            min_val = ref_elev[i]
-            max_val = ref_elev[i + 1]
-        except:
-            min_val = ref_elev[i]
-            max_val = ref_elev[i]
-
-        if min_val == max_val:
-            sub = np.full((photon_count[i]), min_val)
-            arr.append(sub)
-        else:
-            sub_tmp = np.linspace(min_val, max_val, photon_count[i] + 1)
-            if len(sub_tmp) > 1:
-                sub = np.linspace(sub_tmp[1], sub_tmp[-1], photon_count[i])
-                arr.append(sub)
-            else:
-                arr.append(sub_tmp)
-
-    return np.concatenate(arr, axis=None).ravel()
+    """
+    Interpolate segment level values (e.g., ref_elev) to the photon level.
+    Within each segment the values ramp linearly towards the value of the
+    next segment, reaching it at the last photon of the segment. The final
+    segment is held constant.
+    """
+    photon_count = np.asarray(photon_count, dtype=np.int64)
+    ref_elev = np.asarray(ref_elev, dtype=np.float64)
+
+    # index of the first photon of each segment and the total photon count
+    ends = np.cumsum(photon_count)
+    starts = ends - photon_count
+
+    next_vals = np.concatenate([ref_elev[1:], ref_elev[-1:]])
+    step = (next_vals - ref_elev) / np.maximum(photon_count, 1)
+
+    base = np.repeat(ref_elev, photon_count)
+    slope = np.repeat(step, photon_count)
+    # position of each photon within its segment, counted from 1
+    frac = np.arange(1, ends[-1] + 1) - np.repeat(starts, photon_count)
+
+    return base + slope * frac
+
+
+def _bin_codes(values, bin_number):
+    """
+    Assign values to bin_number equal width bins, returning the bin indices.
+    The edges match pd.cut with an integer number of bins (right closed, with
+    the lowest edge extended by 0.1% of the range to include the minimum).
+    """
+    values = np.asarray(values)
+    min_val = values.min()
+    max_val = values.max()
+    edges = np.linspace(min_val, max_val, bin_number + 1)
+    edges[0] -= (max_val - min_val) * 0.001
+
+    return np.searchsorted(edges, values, side="left") - 1
 
 
 def bin_data(dataset, lat_res, height_res):
-    """Bin data along vertical and horizontal scales for later segmentation"""
+    """
+    Bin data along vertical and horizontal scales for later segmentation.
+    dataset is a PhotonTable (or a DataFrame with the same column names) and
+    a PhotonTable with the lat_bins and height_bins indices is returned.
+    """
+    if isinstance(dataset, pd.DataFrame):
+        dataset = PhotonTable.from_dataframe(dataset)
+
+    latitude = dataset.latitude
+    photon_height = dataset.photon_height
 
     # Calculate number of bins required both vertically and horizontally with resolution size
-    lat_bin_number = round(
-        abs(dataset["latitude"].min() - dataset["latitude"].max()) / lat_res
-    )
+    lat_bin_number = round(abs(latitude.min() - latitude.max()) / lat_res)
     height_bin_number = round(
-        abs(dataset["photon_height"].min() - dataset["photon_height"].max())
-        / height_res
+        abs(photon_height.min() - photon_height.max()) / height_res
     )
 
-    # Duplicate dataframe
-    dataset1 = dataset.copy(deep=True)
-
-    # Cut lat bins
-    lat_bins = pd.cut(
-        dataset["latitude"], lat_bin_number, labels=np.array(range(lat_bin_number))
+    # Cut lat and height bins
+    return replace(
+        dataset,
+        lat_bins=_bin_codes(latitude, lat_bin_number),
+        height_bins=_bin_codes(photon_height, height_bin_number),
+        n_lat_bins=lat_bin_number,
+        n_height_bins=height_bin_number,
     )
 
-    # Add bins to dataframe
-    dataset1["lat_bins"] = lat_bins
-
-    # Cut height bins
-    height_bins = pd.cut(
-        dataset["photon_height"],
-        height_bin_number,
-        labels=np.round(
-            np.linspace(
-                dataset["photon_height"].min(),
-                dataset["photon_height"].max(),
-                num=height_bin_number,
-            ),
-            decimals=1,
-        ),
-    )
 
-    # Add height bins to dataframe
-    dataset1["height_bins"] = height_bins
-    dataset1 = dataset1.reset_index(drop=True)
+def _bin_counts(lat_bins, height_bins, n_lat_bins, n_height_bins):
+    """Count the photons in each (latitude bin, height bin) grid cell"""
+    return np.bincount(
+        lat_bins * n_height_bins + height_bins,
+        minlength=n_lat_bins * n_height_bins,
+    ).reshape(n_lat_bins, n_height_bins)
 
-    return dataset1
 
+def _median_per_bin(values, bins, n_bins):
+    """
+    Calculate the median of the (non NaN) values within each of n_bins bins.
+    Bins without any values are NaN.
+    """
+    valid = ~np.isnan(values)
+    values = values[valid]
+    bins = bins[valid]
 
-def get_sea_height(binned_data, surface_buffer=-0.5):
-    """Calculate mean sea height for easier calculation of depth and cleaner figures"""
+    # sort by bin then value so the middle of each bin is its median
+    values = values[np.lexsort((values, bins))]
+    counts = np.bincount(bins, minlength=n_bins)
+    starts = np.cumsum(counts) - counts
 
-    # Create sea height list
-    sea_height = []
+    medians = np.full(n_bins, np.nan)
+    filled = counts > 0
+    lower = starts[filled] + (counts[filled] - 1) // 2
+    upper = starts[filled] + counts[filled] // 2
+    medians[filled] = (values[lower] + values[upper]) / 2
 
-    # Group data by latitude
-    binned_data_sea = binned_data[
-        (binned_data["photon_height"] > surface_buffer)
-    ]  # Filter out subsurface data
-    grouped_data = binned_data_sea.groupby(
-        ["lat_bins"], group_keys=True, observed=False
-    )
-    data_groups = dict(list(grouped_data))
+    return medians
 
-    # Loop through groups and return average sea height
-    for k, v in data_groups.items():
-        # Create new dataframe based on occurance of photons per height bin
-        new_df = pd.DataFrame(v.groupby("height_bins", observed=False).count())
 
-        # Return the bin with the highest count
-        largest_h_bin = new_df["latitude"].argmax()
+def get_sea_height(binned_data, surface_buffer=-0.5):
+    """Calculate mean sea height for easier calculation of depth and cleaner figures"""
+
+    n_lat_bins = binned_data.n_lat_bins
 
-        # Select the index of the bin with the highest count
-        largest_h = new_df.index[largest_h_bin]
+    # Filter out subsurface data
+    binned_data_sea = binned_data.select(binned_data.photon_height > surface_buffer)
+    lat_bins = binned_data_sea.lat_bins
+    height_bins = binned_data_sea.height_bins
 
-        # Calculate the median value of all values within this bin
-        lat_bin_sea_median = v.loc[
-            v["height_bins"] == largest_h, "photon_height"
-        ].median()
+    # Count the occurance of photons per height bin within each latitude
+    # bin and return the bin with the highest count
+    counts = _bin_counts(lat_bins, height_bins, n_lat_bins, binned_data.n_height_bins)
+    largest_h_bin = counts.argmax(axis=1)
 
-        # Append to sea height list
-        sea_height.append(lat_bin_sea_median)
-        del new_df
+    # Calculate the median value of all values within this bin
+    in_bin = height_bins == largest_h_bin[lat_bins]
+    sea_height = _median_per_bin(
+        binned_data_sea.photon_height[in_bin], lat_bins[in_bin], n_lat_bins
+    )
 
     # Filter out sea height bin values outside 2 SD of mean.
     mean = np.nanmean(sea_height, axis=0)
@@ -308,33 +461,31 @@ def get_water_temp(data_path, latitude, longitude):
     return sst
 
 
-def refraction_correction(
+@njit(
+    parallel=True,
+    fastmath={"nsz", "arcp", "contract", "afn", "reassoc"},
+    cache=True,
+)
+def _filter_and_refract(
     water_temp,
     water_surface,
     wavelength,
+    keep,
     photon_ref_elev,
     ph_ref_azimuth,
     photon_z,
     photon_x,
     photon_y,
     ph_conf,
-    satellite_altitude,
 ):
     """
-    WTemp; there is python library that pulls water temp data
-    water_surface is the value surface height
-    Wavelength is fixed
+    Per photon refraction correction, following Parrish et al., 2019.
+    Only photons where keep is True and which are below the water surface
+    are corrected. These are gathered from the (unfiltered) inputs in the
+    same pass, returning the corrected x, y and z followed by the raw
+    conf, x, y, z, azimuth and elevation of the selected photons.
     """
 
-    # Only process photons below water surface model
-    photon_x = photon_x[photon_z <= water_surface]
-    photon_y = photon_y[photon_z <= water_surface]
-    photon_ref_elev = photon_ref_elev[photon_z <= water_surface]
-    satellite_altitude = satellite_altitude[photon_z <= water_surface]
-    ph_ref_azimuth = ph_ref_azimuth[photon_z <= water_surface]
-    ph_conf = ph_conf[photon_z <= water_surface]
-    photon_z = photon_z[photon_z <= water_surface]
-
     # Refraction coefficient #
     a = -0.000001501562500
     b = 0.000000107084865
@@ -348,6 +499,7 @@ def refraction_correction(
 
     # refractive index of water
     n2 = (a * water_temp**2) + (b * wl**2) + (c * water_temp) + (d * wl) + e
+    n1_n2 = n1 / n2
 
     # assumption is 0.25416
     # This example is refractionCoef = 0.25449
@@ -355,192 +507,242 @@ def refraction_correction(
     # correction_coef = (1-(n1/n2))
     #########################
 
-    # read photon ref_elev to get theta1
-    # Does not account for curvature of Earth
-    theta1 = np.pi / 2 - photon_ref_elev
-
     # H = orbital altitude of IS2 (496km as mean)
     # H = 496km. we pass in the mean of the orbit from /geolocation/altitude_sc/
     # Diff from min to max of 100m over an orbit is 0.02% at 496km
     # More error probably introduced from Re (mean Earth radius) than intra-orbit changes in altitude
-    # H = 496
-    H = satellite_altitude / 1000
     # Re = Radius of Earth (6371km mean)
-    Re = 6371
-
     # remove as potentially more inaccurate of a correcttion
     # theta1 = np.arctan((H*np.tan(theta_1))/Re)
 
-    # eq 1. Theta2
-    theta2 = np.arcsin(((n1 * np.sin(theta1)) / n2))
-
-    # eq 3. S
-    # Approximate water Surface = 1.5
-    # D  = raw uncorrected depth
-    D = water_surface - photon_z
-
-    # For Triangle DTS
-    S = D / np.cos(theta1)
-
-    # eq 2. R
-    R = (S * n1) / n2
-    Gamma = (np.pi / 2) - theta1
-
-    # For triangle RpS
-    # phi is an angle needed
-    phi = theta1 - theta2
-
-    # p is the difference between raw and corrected YZ location
-    p = np.sqrt(R**2 + S**2 - 2 * R * S * np.cos(phi))
-
-    # alpha is an angle needed
-    alpha = np.arcsin((R * np.sin(phi)) / p)
-
-    # Beta angle needed for Delta Y an d Delta Z
-    Beta = Gamma - alpha
-
-    # Delta Y
-    DY = p * np.cos(Beta)
-
-    # Delta Z
-    DZ = p * np.sin(Beta)
-
-    # Delta Easting
-    DE = DY * np.sin(ph_ref_azimuth)
-
-    # Delta Northing
-    DN = DY * np.cos(ph_ref_azimuth)
-
-    out_x = photon_x + DE
-    out_y = photon_y + DN
-    out_z = photon_z + DZ
+    # Only process photons passing the filter and below water surface model
+    index = np.empty(photon_z.shape[0], dtype=np.int64)
+    n = 0
+    for i in range(photon_z.shape[0]):
+        if keep[i] and photon_z[i] <= water_surface:
+            index[n] = i
+            n += 1
+
+    # outputs keep the precision of the inputs (e.g., float32 heights)
+    out_x = np.empty(n, dtype=photon_x.dtype)
+    out_y = np.empty(n, dtype=photon_y.dtype)
+    out_z = np.empty(n, dtype=photon_z.dtype)
+    sel_conf = np.empty(n, dtype=ph_conf.dtype)
+    sel_x = np.empty(n, dtype=photon_x.dtype)
+    sel_y = np.empty(n, dtype=photon_y.dtype)
+    sel_z = np.empty(n, dtype=photon_z.dtype)
+    sel_azimuth = np.empty(n, dtype=ph_ref_azimuth.dtype)
+    sel_elev = np.empty(n, dtype=photon_ref_elev.dtype)
+
+    for j in prange(n):
+        i = index[j]
+        sel_conf[j] = ph_conf[i]
+        sel_x[j] = photon_x[i]
+        sel_y[j] = photon_y[i]
+        sel_z[j] = photon_z[i]
+        sel_azimuth[j] = ph_ref_azimuth[i]
+        sel_elev[j] = photon_ref_elev[i]
+
+        # read photon ref_elev to get theta1
+        # Does not account for curvature of Earth
+        theta1 = np.pi / 2 - photon_ref_elev[i]
+
+        # eq 1. Theta2
+        theta2 = np.arcsin(n1_n2 * np.sin(theta1))
+
+        # eq 3. S
+        # D  = raw uncorrected depth
+        D = water_surface - photon_z[i]
+
+        # For Triangle DTS
+        S = D / np.cos(theta1)
+
+        # eq 2. R
+        R = S * n1_n2
+        Gamma = (np.pi / 2) - theta1
+
+        # For triangle RpS
+        # phi is an angle needed
+        phi = theta1 - theta2
+
+        # p is the difference between raw and corrected YZ location
+        p = np.sqrt(R**2 + S**2 - 2 * R * S * np.cos(phi))
+
+        # alpha is an angle needed
+        alpha = np.arcsin((R * np.sin(phi)) / p)
+
+        # Beta angle needed for Delta Y an d Delta Z
+        Beta = Gamma - alpha
+
+        # Delta Y
+        DY = p * np.cos(Beta)
+
+        # Delta Z
+        DZ = p * np.sin(Beta)
+
+        # Delta Easting and Delta Northing
+        out_x[j] = photon_x[i] + DY * np.sin(ph_ref_azimuth[i])
+        out_y[j] = photon_y[i] + DY * np.cos(ph_ref_azimuth[i])
+        out_z[j] = photon_z[i] + DZ
 
     return (
         out_x,
         out_y,
         out_z,
-        ph_conf,
-        photon_x,
-        photon_y,
+        sel_conf,
+        sel_x,
+        sel_y,
+        sel_z,
+        sel_azimuth,
+        sel_elev,
+    )
+
+
+def refraction_correction(
+    water_temp,
+    water_surface,
+    wavelength,
+    photon_ref_elev,
+    ph_ref_azimuth,
+    photon_z,
+    photon_x,
+    photon_y,
+    ph_conf,
+    satellite_altitude,
+    mask=None,
+):
+    """
+    WTemp; there is python library that pulls water temp data
+    water_surface is the value surface height
+    Wavelength is fixed
+    The photon inputs are 1D numpy arrays of equal length and numpy
+    arrays are returned. satellite_altitude is not currently used by
+    the correction.
+    mask is an optional boolean array; if provided only the photons where
+    it is True are corrected (and returned), avoiding the need to filter
+    the inputs beforehand.
+    """
+
+    photon_z = np.asarray(photon_z)
+    if mask is None:
+        mask = np.ones(photon_z.shape[0], dtype=np.bool_)
+
+    return _filter_and_refract(
+        float(water_temp),
+        float(water_surface),
+        float(wavelength),
+        np.asarray(mask, dtype=np.bool_),
+        np.asarray(photon_ref_elev),
+        np.asarray(ph_ref_azimuth),
         photon_z,
-        ph_ref_azimuth,
-        photon_ref_elev,
+        np.asarray(photon_x),
+        np.asarray(photon_y),
+        np.asarray(ph_conf),
     )  # We are most interested in out_x, out_y, out_z
 
 
 def get_bath_height(binned_data, percentile, WSHeight, height_resolution):
     """Calculate bathymetry level per bin based on horizontal resolution"""
-    # Create sea height list
-    bath_height = []
+    n_lat_bins = binned_data.n_lat_bins
+    n_height_bins = binned_data.n_height_bins
 
-    geo_photon_height = []
-    geo_longitude = []
-    geo_latitude = []
+    # Create a percentile threshold of photon counts in each grid, grouped by both x and y axes.
+    grid_counts = _bin_counts(
+        binned_data.lat_bins, binned_data.height_bins, n_lat_bins, n_height_bins
+    )
+    count_threshold = np.percentile(grid_counts.max(axis=1), percentile)
 
-    # Group data by latitude
     # Filter out surface data that are two bins below median surface value calculated above
-    binned_data_bath = binned_data[
-        (binned_data["photon_height"] < WSHeight - (height_resolution * 2))
-    ]
-    grouped_data = binned_data_bath.groupby(
-        ["lat_bins"], group_keys=True, observed=False
+    binned_data_bath = binned_data.select(
+        binned_data.photon_height < WSHeight - (height_resolution * 2)
     )
-    data_groups = dict(list(grouped_data))
+    lat_bins = binned_data_bath.lat_bins
+    height_bins = binned_data_bath.height_bins
+
+    # Find the height bin with the most (corrected) photons in each latitude bin
+    valid_cor = ~np.isnan(binned_data_bath.cor_latitude)
+    bath_bin = _bin_counts(
+        lat_bins[valid_cor], height_bins[valid_cor], n_lat_bins, n_height_bins
+    ).argmax(axis=1)
+    bath_bin_count = _bin_counts(lat_bins, height_bins, n_lat_bins, n_height_bins)[
+        np.arange(n_lat_bins), bath_bin
+    ]
 
-    # Create a percentile threshold of photon counts in each grid, grouped by both x and y axes.
-    count_threshold = np.percentile(
-        binned_data.groupby(["lat_bins", "height_bins"], observed=False)
-        .size()
-        .reset_index()
-        .groupby("lat_bins", observed=False)[[0]]
-        .max(),
-        percentile,
-    )
+    # Set threshold of photon counts per bin
+    above_threshold = bath_bin_count >= count_threshold
+    if not above_threshold.any():
+        raise Exception("There are no geo photo heights.")
 
-    # Loop through groups and return average bathy height
-    for k, v in data_groups.items():
-        new_df = pd.DataFrame(v.groupby("height_bins", observed=False).count())
-        bath_bin = new_df["cor_latitude"].argmax()
-        bath_bin_h = new_df.index[bath_bin]
+    in_bin = (height_bins == bath_bin[lat_bins]) & above_threshold[lat_bins]
+    bath_height = np.where(
+        above_threshold,
+        _median_per_bin(
+            binned_data_bath.cor_photon_height[in_bin], lat_bins[in_bin], n_lat_bins
+        ),
+        np.nan,
+    ).tolist()
 
-        # Set threshold of photon counts per bin
-        if new_df.iloc[bath_bin]["latitude"] >= count_threshold:
+    # Return the classified photons ordered by latitude bin
+    geo_data = binned_data_bath.select(in_bin)
+    geo_data = geo_data.select(np.argsort(geo_data.lat_bins, kind="stable"))
+    geo_df = PhotonTable(
+        latitude=geo_data.cor_latitude,
+        longitude=geo_data.cor_longitude,
+        photon_height=geo_data.cor_photon_height,
+        depth=WSHeight - geo_data.cor_photon_height,
+    )
 
-            geo_photon_height.append(
-                v.loc[v["height_bins"] == bath_bin_h, "cor_photon_height"].values
-            )
-            geo_longitude.append(
-                v.loc[v["height_bins"] == bath_bin_h, "cor_longitude"].values
-            )
-            geo_latitude.append(
-                v.loc[v["height_bins"] == bath_bin_h, "cor_latitude"].values
-            )
+    return bath_height, geo_df
 
-            bath_bin_median = v.loc[
-                v["height_bins"] == bath_bin_h, "cor_photon_height"
-            ].median()
-            bath_height.append(bath_bin_median)
-            del new_df
 
-        else:
-            bath_height.append(np.nan)
-            del new_df
+@lru_cache(maxsize=None)
+def _arrow_write_supported():
+    """
+    Check whether the GPKG can be written from the columnar arrays (rather
+    than feature by feature) through pyogrio's Arrow path. This needs
+    pyarrow, pyogrio >= 0.8 and GDAL >= 3.8. pyogrio is only imported
+    here so importing cshelph stays fast.
+    """
+    if find_spec("pyarrow") is None or find_spec("pyogrio") is None:
+        return False
 
-    if len(geo_photon_height) == 0:
-        raise Exception("There are no geo photo heights.")
+    import pyogrio
 
-    geo_longitude_list = np.concatenate(geo_longitude).ravel().tolist()
-    geo_latitude_list = np.concatenate(geo_latitude).ravel().tolist()
-    geo_photon_list = np.concatenate(geo_photon_height).ravel().tolist()
-    geo_depth = WSHeight - geo_photon_list
-    geo_df = pd.DataFrame(
-        {
-            "longitude": geo_longitude_list,
-            "latitude": geo_latitude_list,
-            "photon_height": geo_photon_list,
-            "depth": geo_depth,
-        }
+    return Version(pyogrio.__version__) >= Version("0.8.0") and (
+        pyogrio.__gdal_version__ >= (3, 8, 0)
     )
 
-    del geo_longitude_list, geo_latitude_list, geo_photon_list
-
-    return bath_height, geo_df
-
 
-def produce_figures(
+def init_figure(
     binned_data,
-    bath_height,
     sea_height,
     y_limit_top,
     y_limit_bottom,
-    percentile,
     file,
-    geo_df,
     RefY,
     RefZ,
-    laser,
-    epsg_num,
 ):
-    """Create figures"""
+    """
+    Create the figure and plot the photons which do not depend on the
+    threshold. Returns the (initially empty) scatter of the classified
+    photons which produce_figures() updates for each threshold.
+    """
+    # deferred so importing cshelph does not import matplotlib
+    import matplotlib.pyplot as plt
 
     # Create bins for latitude
     x_bins = np.linspace(
         binned_data.latitude.min(), binned_data.latitude.max(), len(sea_height)
     )
 
-    # Create new dataframes for median values
-    bath_median_df = pd.DataFrame.from_dict(
-        {"x": x_bins, "y": bath_height}, orient="index"
-    )
-    bath_median_df = bath_median_df.transpose()
-
     # Create uniform sea surface based on median sea surface values
     # and filter out surface breaching
-    sea_surf = [np.nanmedian(sea_height) if i == i else np.nan for i in sea_height]
-    sea_median_df = pd.DataFrame({"x": x_bins, "y": sea_surf})
+    sea_height = np.asarray(sea_height)
+    valid_sea = np.isfinite(sea_height)
+    sea_surf = np.where(valid_sea, np.median(sea_height[valid_sea]), np.nan)
 
     # Define figure size
-    fig = plt.rcParams["figure.figsize"] = (40, 5)
+    plt.figure(figsize=(40, 5))
 
     # plot raw points
     plt.scatter(
@@ -554,22 +756,19 @@ def produce_figures(
         label="Raw photon height",
     )
     plt.scatter(RefY, RefZ, s=0.2, alpha=0.1, c="black")
-    plt.scatter(
-        geo_df.latitude,
-        geo_df.photon_height,
+    scatter_artist = plt.scatter(
+        [],
+        [],
         s=0.5,
         alpha=0.1,
         c="red",
         label="Classified photons",
     )
 
-    # plt.scatter(x=geo_df.latitude, y = geo_df.photon_height, marker='o', lw=0, s=0.8, alpha = 0.8, c = 'black', label = 'Corrected photon bin')
-
     # plot median values
-    # plt.scatter(bath_median_df.x, bath_median_df.y, marker = 'o', c='r', alpha = 0.8, s = 5, label = 'Median bathymetry')
     plt.scatter(
-        sea_median_df.x,
-        sea_median_df.y,
+        x_bins,
+        sea_surf,
         marker="o",
         c="b",
         alpha=1,
@@ -589,12 +788,44 @@ def produce_figures(
     # Limit the x and y axes using parameters
     plt.xlim(left=binned_data.latitude.min(), right=binned_data.latitude.max())
     plt.ylim(top=y_limit_top, bottom=y_limit_bottom)
+    plt.tight_layout()
+
+    return scatter_artist
+
+
+def produce_figures(
+    binned_data,
+    bath_height,
+    sea_height,
+    y_limit_top,
+    y_limit_bottom,
+    percentile,
+    file,
+    geo_df,
+    RefY,
+    RefZ,
+    laser,
+    epsg_num,
+    scatter_artist=None,
+):
+    """
+    Create figures. When processing several thresholds pass the
+    scatter_artist returned by init_figure() so only the classified
+    photons are redrawn; otherwise a new figure is created.
+    """
+
+    if scatter_artist is None:
+        scatter_artist = init_figure(
+            binned_data, sea_height, y_limit_top, y_limit_bottom, file, RefY, RefZ
+        )
+
+    # plot the classified photons for this threshold
+    scatter_artist.set_offsets(np.column_stack((geo_df.latitude, geo_df.photon_height)))
 
     timestr = time.strftime("%Y%m%d%H%M%S")
     file = file.replace(".h5", "")
     # Define where to save file
-    plt.tight_layout()
-    plt.savefig(
+    scatter_artist.figure.savefig(
         file
         + "_gt"
         + str(laser)
@@ -610,22 +841,28 @@ def produce_figures(
     # plt.close()
 
     # convert corrected locations back to wgs84 (useful to contain)
-    transformer = Transformer.from_crs(
-        "EPSG:" + str(epsg_num), "EPSG:4326", always_xy=True
-    )
+    transformer = _get_transformer("EPSG:" + str(epsg_num), "EPSG:4326")
     # print(transformer)
-    lon_wgs84, lat_wgs84 = transformer.transform(
-        geo_df.longitude.values, geo_df.latitude.values
-    )
-
-    geo_df["lon_wgs84"] = lon_wgs84
-    geo_df["lat_wgs84"] = lat_wgs84
+    lon_wgs84, lat_wgs84 = transformer.transform(geo_df.longitude, geo_df.latitude)
 
+    # Build the GeoDataFrame in one step from the photon arrays
     geodf = geopandas.GeoDataFrame(
-        geo_df, geometry=geopandas.points_from_xy(geo_df.lon_wgs84, geo_df.lat_wgs84)
+        {
+            "longitude": geo_df.longitude.astype(np.float64),
+            "latitude": geo_df.latitude.astype(np.float64),
+            "photon_height": geo_df.photon_height.astype(np.float64),
+            "depth": geo_df.depth.astype(np.float64),
+            "lon_wgs84": lon_wgs84,
+            "lat_wgs84": lat_wgs84,
+        },
+        geometry=geopandas.points_from_xy(lon_wgs84, lat_wgs84),
+        crs="EPSG:4326",
     )
 
-    geodf.set_crs(epsg=4326, inplace=True)
+    if _arrow_write_supported():
+        write_kwargs = {"engine": "pyogrio", "use_arrow": True}
+    else:
+        write_kwargs = {}
 
     geodf.to_file(
         file
@@ -639,4 +876,5 @@ def produce_figures(
         + timestr
         + ".gpkg",
         driver="GPKG",
+        **write_kwargs,
     )
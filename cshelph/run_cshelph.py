@@ -14,8 +14,6 @@ import sys
 from cshelph import cshelph
 
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 
 
 def run_cshelph(
@@ -90,108 +88,73 @@ def run_cshelph(
 
         # count number of photons in each segment: DEPRECATED
         # ph_num_per_seg = count_ph_per_seg(ph_index_beg, photon_h)
-        ph_num_per_seg = seg_ph_count[ph_index_beg > 0]
-        # Cast as an int
-        ph_num_per_seg = ph_num_per_seg.astype(np.int64)
+        valid_seg = ph_index_beg > 0
+        # (read_atl03 returns the counts as int64)
+        ph_num_per_seg = seg_ph_count[valid_seg]
 
         # count_ph_per_seg() function removes zeros from ph_index_beg
         # These 0s are nodata vals in other params (ref_elev etc)
         # Thus no pre-processing is needed as it will map correctly given
         # the nodata values are eliminated
-        ph_ref_elev = cshelph.ref_linear_interp(
-            ph_num_per_seg, ref_elev[ph_index_beg > 0]
-        )
+        ph_ref_elev = cshelph.ref_linear_interp(ph_num_per_seg, ref_elev[valid_seg])
         ph_ref_azimuth = cshelph.ref_linear_interp(
-            ph_num_per_seg, ref_azimuth[ph_index_beg > 0]
+            ph_num_per_seg, ref_azimuth[valid_seg]
         )
-        ph_sat_alt = cshelph.ref_linear_interp(ph_num_per_seg, alt_sc[ph_index_beg > 0])
+        ph_sat_alt = cshelph.ref_linear_interp(ph_num_per_seg, alt_sc[valid_seg])
+
+        # Heights and angles are held as float32 for the binning and
+        # refraction stages; the UTM coordinates stay float64 as float32
+        # cannot resolve them to better than ~0.1m over a granule.
+        photon_h = photon_h.astype(np.float32)
+        ph_ref_elev = ph_ref_elev.astype(np.float32)
+        ph_ref_azimuth = ph_ref_azimuth.astype(np.float32)
 
         ###########################################################################
         ########### Hacked Solution to Resolving Differences in Length ############
         ###########################################################################
-        lat_utm_len = len(lat_utm)
-        lon_utm_len = len(lon_utm)
-        photon_h_len = len(photon_h)
-        conf_len = len(conf)
-        if (
-            (lat_utm_len != lon_utm_len)
-            and (conf_len != lon_utm_len)
-            and (conf_len != photon_h_len)
-        ):
-            raise Exception("lat_utm, lon_utm and conf_len must have same length")
-
-        ph_ref_elev_len = len(ph_ref_elev)
-        ph_ref_azimuth_len = len(ph_ref_azimuth)
-        ph_sat_alt_len = len(ph_sat_alt)
-
-        if (ph_ref_elev_len != ph_ref_azimuth_len) and (
-            ph_ref_azimuth_len != ph_sat_alt_len
-        ):
-            raise Exception(
-                "ph_ref_elev, ph_ref_azimuth and ph_sat_alt must have same length"
+        # The interpolated segment parameters and the photon level data can
+        # differ in length so truncate all of them to the common length
+        n_photons = min(len(lat_utm), len(ph_ref_elev))
+        lat_utm, lon_utm, photon_h, conf, ph_ref_elev, ph_ref_azimuth, ph_sat_alt = (
+            arr[:n_photons]
+            for arr in (
+                lat_utm,
+                lon_utm,
+                photon_h,
+                conf,
+                ph_ref_elev,
+                ph_ref_azimuth,
+                ph_sat_alt,
             )
-
-        if lat_utm_len != ph_ref_elev_len:
-            if ph_ref_elev_len > lat_utm_len:
-                ph_ref_elev = ph_ref_elev[0:lat_utm_len]
-                ph_ref_azimuth = ph_ref_azimuth[0:lat_utm_len]
-                ph_sat_alt = ph_sat_alt[0:lat_utm_len]
-            elif lat_utm_len > ph_ref_elev_len:
-                lat_utm = lat_utm[0:ph_ref_elev_len]
-                lon_utm = lon_utm[0:ph_ref_elev_len]
-                photon_h = photon_h[0:ph_ref_elev_len]
-                conf = conf[0:ph_ref_elev_len]
-            else:
-                raise Exception("Interpolated variables do not have same length")
+        )
         ###########################################################################
         ###########################################################################
 
-        # Aggregate data into dataframe
-        dataset_sea = pd.DataFrame(
-            {
-                "latitude": lat_utm,
-                "longitude": lon_utm,
-                "photon_height": photon_h,
-                "confidence": conf,
-                "ref_elevation": ph_ref_elev,
-                "ref_azminuth": ph_ref_azimuth,
-                "ref_sat_alt": ph_sat_alt,
-            },
-            columns=[
-                "latitude",
-                "longitude",
-                "photon_height",
-                "confidence",
-                "ref_elevation",
-                "ref_azminuth",
-                "ref_sat_alt",
-            ],
+        # Filter data that should not be analyzed in a single pass:
+        # quality flags, elevation range and (optionally) specific latitude
+        mask = (
+            (conf != 0)
+            & (conf != 1)
+            & (photon_h > min_buffer)
+            & (photon_h < max_buffer)
         )
-
-        # plt.scatter(lat_utm, photon_h, c='black', s=0.1, alpha=0.1)
-        # plt.show()
-        # Filter data that should not be analyzed
-        # Filter for quality flags
-        dataset_sea1 = dataset_sea[
-            (dataset_sea.confidence != 0) & (dataset_sea.confidence != 1)
-        ]
-        # Filter for elevation range
-        dataset_sea1 = dataset_sea1[
-            (dataset_sea1["photon_height"] > min_buffer)
-            & (dataset_sea1["photon_height"] < max_buffer)
-        ]
-
-        # Focus on specific latitude
         if start_lat is not None:
-            dataset_sea1 = dataset_sea1[
-                (dataset_sea1["latitude"] > start_lat)
-                & (dataset_sea1["latitude"] < end_lat)
-            ]
+            mask &= (lat_utm > start_lat) & (lat_utm < end_lat)
+
+        # Aggregate the filtered data needed to find the sea surface into a
+        # photon table. The refraction correction applies the same mask
+        # itself so the remaining columns are not copied here.
+        dataset_sea1 = cshelph.PhotonTable(
+            latitude=lat_utm[mask],
+            longitude=lon_utm[mask],
+            photon_height=photon_h[mask],
+            confidence=conf[mask],
+        )
 
         # plt.scatter(dataset_sea1['latitude'], dataset_sea1['photon_height'],c='black',s=0.2,alpha=0.1)
         # plt.show()
         # Bin dataset
-        print(dataset_sea1.head())
+        print(dataset_sea1.select(slice(0, 5)).to_dataframe())
         binned_data_sea = cshelph.bin_data(dataset_sea1, lat_res, h_res)
 
         # Find mean sea height
@@ -203,7 +166,8 @@ def run_cshelph(
         sea_height = cshelph.get_sea_height(binned_data_sea, surface_buffer)
 
         # Set sea height
-        med_water_surface_h = np.nanmedian(sea_height)
+        sh = np.asarray(sea_height)
+        med_water_surface_h = np.median(sh[np.isfinite(sh)])
 
         # Calculate sea temperature
         if water_temp is None:
@@ -222,47 +186,39 @@ def run_cshelph(
                 water_temp,
                 med_water_surface_h,
                 532,
-                dataset_sea1.ref_elevation,
-                dataset_sea1.ref_azminuth,
-                dataset_sea1.photon_height,
-                dataset_sea1.longitude,
-                dataset_sea1.latitude,
-                dataset_sea1.confidence,
-                dataset_sea1.ref_sat_alt,
+                ph_ref_elev,
+                ph_ref_azimuth,
+                photon_h,
+                lon_utm,
+                lat_utm,
+                conf,
+                ph_sat_alt,
+                mask=mask,
             )
         )
 
         # Find bathy depth
-        depth = med_water_surface_h - ref_z
+        depth = (med_water_surface_h - ref_z).astype(np.float32)
 
-        # Create new dataframe with refraction corrected data
-        dataset_bath = pd.DataFrame(
-            {
-                "latitude": raw_y,
-                "longitude": raw_x,
-                "cor_latitude": ref_y,
-                "cor_longitude": ref_x,
-                "cor_photon_height": ref_z,
-                "photon_height": raw_z,
-                "confidence": ref_conf,
-                "depth": depth,
-            },
-            columns=[
-                "latitude",
-                "longitude",
-                "photon_height",
-                "cor_latitude",
-                "cor_longitude",
-                "cor_photon_height",
-                "confidence",
-                "depth",
-            ],
+        # Create new photon table with refraction corrected data
+        dataset_bath = cshelph.PhotonTable(
+            latitude=raw_y,
+            longitude=raw_x,
+            photon_height=raw_z,
+            cor_latitude=ref_y,
+            cor_longitude=ref_x,
+            cor_photon_height=ref_z,
+            confidence=ref_conf,
+            depth=depth,
         )
 
         # Bin dataset again for bathymetry
         binned_data = cshelph.bin_data(dataset_bath, lat_res, h_res)
 
         print("Locating bathymetric photons...")
+        # matplotlib is only imported once the figures are needed
+        import matplotlib.pyplot as plt
+
         if isinstance(thresh, int):
             # Find bathymetry
             bath_height, geo_df = cshelph.get_bath_height(
@@ -287,14 +243,17 @@ def run_cshelph(
                 epsg_num,
             )
         elif isinstance(threshlist, list):
+            # Create figure, reused for each threshold
+            plt.close()
+            scatter_artist = cshelph.init_figure(
+                binned_data, sea_height, 10, -20, input_h5_file, ref_y, ref_z
+            )
             for thresh in threshlist:
                 print("using threshold:", str(thresh))
                 bath_height, geo_df = cshelph.get_bath_height(
                     binned_data, int(thresh), med_water_surface_h, h_res
                 )
 
-                # Create figure
-                plt.close()
                 print("Creating figs and writing to GPKG")
                 cshelph.produce_figures(
                     binned_data,
@@ -309,6 +268,7 @@ def run_cshelph(
                     ref_z,
                     laser_num,
                     epsg_num,
+                    scatter_artist=scatter_artist,
                 )
     except Exception as e:
         raise e